@@ -1,14 +1,12 @@
-from app.tools.db_tools import store_analysis_tool, add_to_master_surgeries_tool, get_master_surgeries_tool, get_master_surgeries_with_steps_tool
+from app.tools.db_tools import store_analysis_tool, add_to_master_surgeries_tool, get_master_surgeries_tool, find_similar_master_surgeries_tool, get_master_surgeries_with_steps_tool
 from langchain_core.messages import HumanMessage
-from langchain_google_vertexai import ChatVertexAI  # Uses Vertex AI as LLM
-import os  # For environment variables
-
-from pydantic import BaseModel, Field
+from pydantic import ValidationError
+from typing import Union
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-import sys
-import os
+import asyncio
 from app.utils.functions import create_agent
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.llm import get_llm
+from app.model import ComparisonResult
 
 # System prompt for surgery analysis agent
 SURGERY_ANALYSIS_PROMPT = """
@@ -16,20 +14,20 @@ You are an expert surgical video analysis agent. Your primary task is to analyze
 
 **IMPORTANT: You must follow this two-step workflow precisely. Do not skip steps.**
 
-**Step 1: Store Initial Analysis**
-Your first priority is to call the `store_analysis_tool`. To do this, you must parse the provided raw analysis and extract the following five fields:
+**Step 1: Store Initial Analysis and Check the Master Collection**
+Parse the provided raw analysis and extract the following five fields:
 1.  `video_id`: The identifier for the video.
 2.  `surgery_type`: The type of surgery performed.
 3.  `procedure_steps`: A detailed, timestamped list of events.
 4.  `description`: The full, detailed description of the procedure from the analysis.
 5.  `summary`: A concise, 2-3 sentence summary of the procedure.
 
-Once you have all five fields, call the `store_analysis_tool` immediately. This is a mandatory first step.
+Once you have all five fields, call the `store_analysis_tool` AND the `find_similar_master_surgeries_tool` (with the extracted `surgery_type` and `summary`) in the same turn, as parallel tool calls. The two calls are independent, so do not wait for one to finish before making the other. Storing the analysis is a mandatory first step.
 
 **Step 2: Update the Master Collection**
-After you have called `store_analysis_tool`, you will then manage the `master_surgeries` collection. You will use the data you already extracted (`surgery_type`, `procedure_steps`, `summary`).
+Using the candidate master surgeries returned by `find_similar_master_surgeries_tool`, you will then manage the `master_surgeries` collection. You will use the data you already extracted (`surgery_type`, `procedure_steps`, `summary`).
 
-1.  **Check for Existing Surgery:** Use the `get_master_surgeries_tool` to check if a similar surgery already exists in the master collection. Compare the `surgery_type` to find a match.
+1.  **Check for Existing Surgery:** Compare the `surgery_type` and `summary` against the returned candidates to find a match. Only if no candidates were returned, use the `get_master_surgeries_tool` to check the full master collection for the same surgery recorded under a different name.
 
 2.  **Handle the Master Record:**
     - **If a match is found:**
@@ -81,14 +79,8 @@ Extracted procedure_steps:
 
 """
 
-# Vertex AI LLM setup (see .env for GOOGLE_CLOUD_PROJECT and GOOGLE_CLOUD_LOCATION)
-llm = ChatVertexAI(
-    model_name="gemini-2.5-flash-preview-05-20",
-    project=os.getenv("GOOGLE_CLOUD_PROJECT"),
-    location=os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1"),
-    temperature=0.3,
-    streaming=False
-)
+# Vertex AI LLM shared by both agents (see .env for GOOGLE_CLOUD_PROJECT and GOOGLE_CLOUD_LOCATION)
+llm = get_llm()
 
 surgery_analysis_prompt_template = ChatPromptTemplate.from_messages([
     ("system", SURGERY_ANALYSIS_PROMPT),
@@ -110,7 +102,7 @@ You are an expert surgical assistant. Your task is to analyze a raw surgical ana
 5. Also extract the overall `surgery_type` and create a brief `summary` from the raw analysis.
 
 **Part 2: Comparison and Step Analysis**
-1. Once you have the formatted data, use the `get_master_surgeries_with_steps` tool to retrieve the master collection.
+1. Once you have the formatted data, use the `get_master_surgeries_with_steps` tool to retrieve the master collection. The tool returns one page of surgeries at a time: if the page has no matching surgery and `next_after_id` is not null, call the tool again with that `next_after_id`, and stop as soon as you find a match or reach the last page. Each master procedure step is already split into an object with `start` and `end` timestamps and a `desc` description; compare steps using their `desc`.
 2. Find a matching surgery in the master collection by first comparing `surgery_type` and then `summary`.
 3. If a match is found:
     a. You have two lists of steps: the `current_procedure_steps` (with timestamps) and the `master_procedure_steps`.
@@ -122,9 +114,9 @@ You are an expert surgical assistant. Your task is to analyze a raw surgical ana
     g. The `missing_steps` list must be a list of JSON objects, each with two keys: `missing_step` (the description) and `should_occur_after` (the timestamp).
     h. Construct a final JSON object containing:
         - `current_procedure_steps`: The procedure steps from the fresh analysis, WITH their original timestamps.
-        - `master_procedure_steps`: The procedure steps from the matched master record.
+        - `master_procedure_steps`: The `desc` of each procedure step from the matched master record.
         - `missing_steps`: The list of JSON objects you just created. If no steps are missing, this should be an empty list.
-4. If no similar surgery is found after checking both `surgery_type` and `summary`, you must return the message: "no similar data found".
+4. If no similar surgery is found on any page after checking both `surgery_type` and `summary`, you must return the message: "no similar data found".
 
 **Input:**
 - A raw surgical analysis output.
@@ -137,11 +129,7 @@ The `current_procedure_steps` in your JSON output must follow this exact format:
 [
     "00:00:00 - 00:00:07 : Display of title slides and medical imaging (X-rays and MRI) of a patient's lumbar spine, indicating a diagnosis of a migrated disc herniation at L4-L5.",
     "00:00:07 - 00:00:12 : Endoscopic view showing identification of anatomical structures within the spinal canal, specifically the inferior articular process (IAP), superior articular process (SAP), and the ligamentum flavum (ligamento amarelo).",
-    "00:00:12 - 00:00:21 : Endoscopic burr or shaver used to mill or resect portions of the inferior and superior articular facets, with bone fragments visible.",
-    "00:00:21 - 00:00:32 : Instrument used to open or resect the ligamentum flavum and further open the superior facet.",
-    "00:00:32 - 00:00:40 : Instrument with a beveled tip rotating within the endoscopic field, appearing to adjust orientation or create space.",
-    "00:00:40 - 00:00:45 : Grasping forceps or rongeur used to resect and remove a white, somewhat gelatinous or fibrous disc fragment.",
-    "00:00:45 - 00:00:53 : External view of two surgeons performing the procedure, manipulating a long, slender endoscopic instrument inserted into the patient's lower back, with a bright light emanating from its tip.",
+    ...
     "00:00:53 - 00:00:55 : Final image displaying the resected disc fragment, which is white and irregular in shape, placed on a gauze pad next to a syringe for scale, measuring approximately 3-4 cm in length."
 ]
 
@@ -164,7 +152,7 @@ comparison_surgery_prompt_template = ChatPromptTemplate.from_messages([
 
 analyze_surgury_analysis = create_agent(
     llm=llm,
-    tools=[store_analysis_tool, get_master_surgeries_tool, add_to_master_surgeries_tool],
+    tools=[store_analysis_tool, find_similar_master_surgeries_tool, get_master_surgeries_tool, add_to_master_surgeries_tool],
     system_prompt=surgery_analysis_prompt_template,
 )
 
@@ -174,24 +162,73 @@ comparison_surgery = create_agent(
     system_prompt=comparison_surgery_prompt_template,
 )
 
-if __name__ == "__main__":
-    # Test the agent with a sample query
+NO_SIMILAR_DATA = "no similar data found"
+
+def parse_comparison_output(output: str) -> Union[ComparisonResult, str]:
+    """
+    Validate the comparison agent's final answer against the ComparisonResult schema.
+
+    Gemini does not allow a JSON response schema together with function calling,
+    so the format is enforced here rather than at decode time.
+
+    Returns:
+        The parsed ComparisonResult, or the "no similar data found" message
+    """
+    text = output.strip()
+    # Tolerate a markdown code fence around the JSON despite the prompt's instructions
+    if text.startswith("```"):
+        text = text.strip("`").strip()
+        if text.lower().startswith("json"):
+            text = text[4:]
+    # The model often ends the sentence, e.g. "No similar data found."
+    if text.strip().strip('"').rstrip(".! ").lower() == NO_SIMILAR_DATA:
+        return NO_SIMILAR_DATA
+    return ComparisonResult.model_validate_json(text)
+
+async def run_agents(query: str):
+    """
+    Run the analysis and comparison agents concurrently on the same raw analysis.
+
+    The analysis agent may add this surgery to the master collection while the
+    comparison agent is paging through it, so whether the comparison sees the
+    new record (and matches the surgery against itself) depends on timing.
+    """
+    state = {"messages": [HumanMessage(content=query)]}
+    return await asyncio.gather(
+        analyze_surgury_analysis.ainvoke(state, config={"run_name": "surgery_analysis"}),
+        comparison_surgery.ainvoke(state, config={"run_name": "comparison_surgery"}),
+    )
+
+async def _main():
+    """Read queries from stdin and run both agents on each, until 'q' is entered"""
+    # Test the agents with a sample query
     while True:
-        query = input("Enter a query for analysis (or 'q' to quit): ")
+        query = await asyncio.to_thread(input, "Enter a query for analysis (or 'q' to quit): ")
         if query.lower() == 'q':
             break
         
-        # Step 1: Get the raw analysis from the first agent
-        print("\n--- Running Surgery Analysis Agent ---")
-        analysis_state = {"messages": [HumanMessage(content=query)]}
-        analysis_result = analyze_surgury_analysis.invoke(analysis_state)
-        raw_analysis = analysis_result["output"] if isinstance(analysis_result, dict) and "output" in analysis_result else analysis_result
+        # Both agents only need the raw analysis, so their tool waits can overlap
+        print("\n--- Running Surgery Analysis and Comparison Agents ---")
+        analysis_result, comparison_result = await run_agents(query)
         print("Analysis Agent Response:")
-        print(raw_analysis)
-
-        # Step 2: Pass the raw analysis to the comparison agent
-        print("\n--- Running Comparison Surgery Agent ---")
-        comparison_state = {"messages": [HumanMessage(content=raw_analysis)]}
-        comparison_result = comparison_surgery.invoke(comparison_state)
-        print("Comparison Agent Response:")
-        print(comparison_result["output"] if isinstance(comparison_result, dict) and "output" in comparison_result else comparison_result)
+        print(analysis_result["output"] if isinstance(analysis_result, dict) and "output" in analysis_result else analysis_result)
+
+        print("\nComparison Agent Response:")
+        comparison_output = comparison_result["output"] if isinstance(comparison_result, dict) and "output" in comparison_result else str(comparison_result)
+        try:
+            comparison = parse_comparison_output(comparison_output)
+            print(comparison if isinstance(comparison, str) else comparison.model_dump_json(indent=2))
+        except ValidationError as e:
+            print(f"Comparison output did not match the expected schema: {e}")
+            print(comparison_output)
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    
+    # One event loop for the whole session: the shared llm caches an async client
+    # bound to the loop it was first used on
+    asyncio.run(_main())
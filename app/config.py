@@ -1,34 +1,73 @@
 import os
-from pydantic_settings import BaseSettings
-from functools import lru_cache
+from dataclasses import dataclass
+from typing import Optional
+from dotenv import load_dotenv
 
-class Settings(BaseSettings):
+# Load .env once; variables already set in the environment take precedence
+load_dotenv()
+
+@dataclass(frozen=True, slots=True)
+class Settings:
     """Application settings."""
     # MongoDB settings
-    MONGODB_URI: str = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
-    MONGODB_DB_NAME: str = os.getenv("MONGODB_DB_NAME", "surgery_video_analysis")
-    
+    MONGODB_URI: str
+    MONGODB_DB_NAME: str
+    MONGODB_MAX_POOL_SIZE: int
+    MONGODB_MIN_POOL_SIZE: int
+
     # Google Cloud settings
-    GOOGLE_CLOUD_PROJECT: str = os.getenv("GOOGLE_CLOUD_PROJECT", "")
-    GOOGLE_CLOUD_LOCATION: str = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
-    GOOGLE_APPLICATION_CREDENTIALS: str = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "")
-    
+    GOOGLE_CLOUD_PROJECT: str
+    GOOGLE_CLOUD_LOCATION: str
+    GOOGLE_APPLICATION_CREDENTIALS: str
+
+    # Master surgery settings (Atlas vector search is disabled when the index name is empty)
+    MASTER_VECTOR_INDEX: str
+    EMBEDDING_MODEL_NAME: str
+    MASTER_CACHE_TTL_SECONDS: float  # How long master collection reads are served from memory
+
     # Video analysis settings
-    MAX_CHUNK_DURATION_MINUTES: int = 10  # Maximum duration of video chunks in minutes
-    
+    MAX_CHUNK_DURATION_MINUTES: int  # Maximum duration of video chunks in minutes
+    MAX_VIDEO_SIZE_MB: int  # Largest accepted video upload
+    MAX_CONCURRENT_ANALYSES: int  # Worker threads for blocking Vertex AI video analysis
+    VERTEX_CONCURRENCY: int  # Chunk requests in flight per video; keep within the Vertex AI quota
+    VIDEO_CHUNK_BUCKET: str  # GCS bucket chunks are uploaded to; chunks are sent inline when empty
+
     # Additional settings that might be in environment variables
-    langsmith_tracing: str = None
-    langsmith_endpoint: str = None
-    langsmith_api_key: str = None
-    langsmith_project: str = None
-    google_application_credentials: str = None
-    mongodb_password: str = None
-    
-    class Config:
-        env_file = ".env"
-        extra = "ignore"  
-
-@lru_cache()
-def get_settings():
-    """Cached settings to avoid reloading"""
-    return Settings()
+    langsmith_tracing: Optional[str] = None
+    langsmith_endpoint: Optional[str] = None
+    langsmith_api_key: Optional[str] = None
+    langsmith_project: Optional[str] = None
+    google_application_credentials: Optional[str] = None
+    mongodb_password: Optional[str] = None
+
+def _load_settings() -> Settings:
+    """Build settings from environment variables"""
+    return Settings(
+        MONGODB_URI=os.getenv("MONGODB_URI", "mongodb://localhost:27017"),
+        MONGODB_DB_NAME=os.getenv("MONGODB_DB_NAME", "surgery_video_analysis"),
+        MONGODB_MAX_POOL_SIZE=int(os.getenv("MONGODB_MAX_POOL_SIZE", "20")),
+        MONGODB_MIN_POOL_SIZE=int(os.getenv("MONGODB_MIN_POOL_SIZE", "2")),
+        GOOGLE_CLOUD_PROJECT=os.getenv("GOOGLE_CLOUD_PROJECT", ""),
+        GOOGLE_CLOUD_LOCATION=os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1"),
+        GOOGLE_APPLICATION_CREDENTIALS=os.getenv("GOOGLE_APPLICATION_CREDENTIALS", ""),
+        MASTER_VECTOR_INDEX=os.getenv("MASTER_VECTOR_INDEX", ""),
+        EMBEDDING_MODEL_NAME=os.getenv("EMBEDDING_MODEL_NAME", "text-embedding-005"),
+        MASTER_CACHE_TTL_SECONDS=float(os.getenv("MASTER_CACHE_TTL_SECONDS", "30")),
+        MAX_CHUNK_DURATION_MINUTES=int(os.getenv("MAX_CHUNK_DURATION_MINUTES", "10")),
+        MAX_VIDEO_SIZE_MB=int(os.getenv("MAX_VIDEO_SIZE_MB", "10240")),
+        MAX_CONCURRENT_ANALYSES=int(os.getenv("MAX_CONCURRENT_ANALYSES", "4")),
+        VERTEX_CONCURRENCY=int(os.getenv("VERTEX_CONCURRENCY", "4")),
+        VIDEO_CHUNK_BUCKET=os.getenv("VIDEO_CHUNK_BUCKET", ""),
+        langsmith_tracing=os.getenv("LANGSMITH_TRACING"),
+        langsmith_endpoint=os.getenv("LANGSMITH_ENDPOINT"),
+        langsmith_api_key=os.getenv("LANGSMITH_API_KEY"),
+        langsmith_project=os.getenv("LANGSMITH_PROJECT"),
+        google_application_credentials=os.getenv("GOOGLE_APPLICATION_CREDENTIALS"),
+        mongodb_password=os.getenv("MONGODB_PASSWORD"),
+    )
+
+_SETTINGS = _load_settings()
+
+def get_settings() -> Settings:
+    """Process-wide settings, loaded once at import"""
+    return _SETTINGS
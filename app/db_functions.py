@@ -1,15 +1,80 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from datetime import datetime
+from bson.objectid import ObjectId
 from app.mongodb_client import mongodb_client
+from app.config import get_settings
+from app.llm import get_embeddings
 import logging
+import re
+import threading
+import time
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+# Logging is configured by the application entrypoint
 logger = logging.getLogger("db_functions")
 
+settings = get_settings()
+
+# Master collection reads return every document, so fetch them in large batches
+# and only transfer the fields the agents actually use
+MASTER_CURSOR_BATCH_SIZE = 1000
+MASTER_SUMMARY_PROJECTION = {"surgery_type": 1, "summary": 1}
+MASTER_STEPS_PROJECTION = {"surgery_type": 1, "summary": 1, "procedure_steps": 1}
+MASTER_TYPE_MATCH_LIMIT = 20
+MASTER_PAGE_SIZE = 20
+MASTER_SIMILAR_LIMIT = 3
+MASTER_VECTOR_CANDIDATES = 50
+
+# Procedure steps are stored as "HH:MM:SS - HH:MM:SS : description"
+_STEP_RE = re.compile(r"^\s*(\d{1,2}:\d{2}:\d{2})\s*[-–]\s*(\d{1,2}:\d{2}:\d{2})\s*:\s*(.*)$", re.DOTALL)
+
+# In-process cache for master collection reads. The collection only changes
+# through add_to_master_surgeries_db, which bumps the version to invalidate it;
+# the TTL bounds staleness from writes made by other processes.
+_master_cache: Dict[str, Tuple[int, float, Any]] = {}
+_master_version = 0
+_master_cache_lock = threading.Lock()
+
+def _get_cached_master(key: str) -> Optional[Any]:
+    """Return the cached master read for key if it is current and within the TTL"""
+    with _master_cache_lock:
+        entry = _master_cache.get(key)
+        if entry is None:
+            return None
+        version, fetched_at, data = entry
+        if version != _master_version or time.monotonic() - fetched_at >= settings.MASTER_CACHE_TTL_SECONDS:
+            return None
+        return data
+
+def _set_cached_master(key: str, version: int, data: Any) -> None:
+    """Cache a master read, unless the collection was written to while it was fetched"""
+    with _master_cache_lock:
+        if version == _master_version:
+            _master_cache[key] = (version, time.monotonic(), data)
+
+def _parse_procedure_step(step: Any) -> Dict[str, Optional[str]]:
+    """Split a timestamped procedure step into its start, end and description"""
+    step = str(step)
+    match = _STEP_RE.match(step)
+    if match is None:
+        return {"start": None, "end": None, "desc": step}
+    return {"start": match[1], "end": match[2], "desc": match[3]}
+
+def _format_master_surgery_with_steps(surgery: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape a projected master document for the comparison agent"""
+    return {
+        "id": str(surgery["_id"]),
+        "surgery_type": surgery.get("surgery_type", ""),
+        "procedure_steps": [_parse_procedure_step(step) for step in surgery.get("procedure_steps", [])],
+        "summary": surgery.get("summary", "")
+    }
+
+def invalidate_master_cache() -> None:
+    """Drop all cached master collection reads"""
+    global _master_version
+    with _master_cache_lock:
+        _master_version += 1
+        _master_cache.clear()
+
 def store_analysis_in_db(
     video_id: str,
     surgery_type: str,
@@ -21,7 +86,7 @@ def store_analysis_in_db(
     Store the video analysis in the MongoDB analysis collection
     
     Args:
-        video_id: Name/ID of the video file
+        video_id: Content hash identifying the video file
         surgery_type: Type of surgery identified
         procedure_steps: List of timestamped procedure steps
         description: Detailed description of the procedure
@@ -40,10 +105,10 @@ def store_analysis_in_db(
     
     try:
         analysis_id = mongodb_client.store_analysis(analysis_data)
-        logger.info(f"Analysis stored with ID: {analysis_id}")
+        logger.info("Analysis stored with ID: %s", analysis_id)
         return str(analysis_id)
     except Exception as e:
-        logger.error(f"Error storing analysis in MongoDB: {str(e)}")
+        logger.error("Error storing analysis in MongoDB: %s", e)
         return f"Error storing analysis: {str(e)}"
 
 def get_master_surgeries_db() -> List[Dict[str, Any]]:
@@ -53,35 +118,125 @@ def get_master_surgeries_db() -> List[Dict[str, Any]]:
     Returns:
         List of all surgery details from master surgeries collection
     """
+    cached = _get_cached_master("summaries")
+    if cached is not None:
+        return cached
+    
+    version = _master_version
     try:
-        # Always get all surgeries from the master collection
-        surgeries = mongodb_client.master_collection.find()
+        # Always get all surgeries from the master collection, fetching only the
+        # fields we return and pulling them in as few round trips as possible
+        surgeries = list(mongodb_client.master_collection.find(
+            {},
+            projection=MASTER_SUMMARY_PROJECTION,
+            batch_size=MASTER_CURSOR_BATCH_SIZE
+        ))
         
-        # Convert to list and format the results
-        result = []
-        for surgery in surgeries:
-            # Extract original_surgery_types if available
-            # original_types = []
-            # if "original_surgery_types" in surgery and surgery["original_surgery_types"]:
-            #     for orig in surgery["original_surgery_types"]:
-            #         original_types.append({
-            #             "name": orig.get("name", ""),
-            #             "summary": orig.get("summary", "")
-            #         })
-            
-            result.append({
+        # Format the results
+        result = [
+            {
                 "id": str(surgery["_id"]),
                 "surgery_type": surgery.get("surgery_type", ""),
                 "summary": surgery.get("summary", ""),
-                # "original_surgery_types": original_types
-            })
+            }
+            for surgery in surgeries
+        ]
         
-        logger.info(f"Retrieved {len(result)} surgeries from master collection")
+        logger.info("Retrieved %d surgeries from master collection", len(result))
+        _set_cached_master("summaries", version, result)
         return result
     except Exception as e:
-        logger.error(f"Error retrieving master surgeries: {str(e)}")
+        logger.error("Error retrieving master surgeries: %s", e)
         return []
 
+def get_master_surgeries_by_type_db(surgery_type: str) -> List[Dict[str, Any]]:
+    """
+    Get master surgeries whose surgery type starts with the given name (case-insensitive)
+    
+    Args:
+        surgery_type: Type of surgery to look up
+        
+    Returns:
+        List of up to MASTER_TYPE_MATCH_LIMIT matching surgery details
+    """
+    try:
+        # An anchored regex walks the surgery_type index keys instead of every document
+        surgeries = mongodb_client.master_collection.find(
+            {"surgery_type": {"$regex": f"^{re.escape(surgery_type.strip())}", "$options": "i"}},
+            projection=MASTER_SUMMARY_PROJECTION
+        ).limit(MASTER_TYPE_MATCH_LIMIT)
+        
+        result = [
+            {
+                "id": str(surgery["_id"]),
+                "surgery_type": surgery.get("surgery_type", ""),
+                "summary": surgery.get("summary", ""),
+            }
+            for surgery in surgeries
+        ]
+        
+        logger.info("Retrieved %d master surgeries matching type '%s'", len(result), surgery_type)
+        return result
+    except Exception as e:
+        logger.error("Error retrieving master surgeries by type: %s", e)
+        return []
+
+def _embed_master_text(surgery_type: str, summary: str) -> List[float]:
+    """Embed the text that master surgeries are matched on"""
+    return get_embeddings().embed_query(f"{surgery_type}\n{summary}")
+
+def find_similar_master_surgeries_db(
+    surgery_type: str,
+    summary: str,
+    limit: int = MASTER_SIMILAR_LIMIT
+) -> List[Dict[str, Any]]:
+    """
+    Get the master surgeries most similar to the given surgery type and summary
+    
+    Uses Atlas vector search over the stored embeddings when MASTER_VECTOR_INDEX is
+    configured, and falls back to the surgery type lookup otherwise.
+    
+    Args:
+        surgery_type: Type of surgery to match
+        summary: Summary of the procedure to match
+        limit: Maximum number of ranked candidates from vector search
+        
+    Returns:
+        List of candidate surgery details, most similar first
+    """
+    if not settings.MASTER_VECTOR_INDEX:
+        return get_master_surgeries_by_type_db(surgery_type)
+    
+    try:
+        surgeries = mongodb_client.master_collection.aggregate([
+            {
+                "$vectorSearch": {
+                    "index": settings.MASTER_VECTOR_INDEX,
+                    "path": "embedding",
+                    "queryVector": _embed_master_text(surgery_type, summary),
+                    "numCandidates": MASTER_VECTOR_CANDIDATES,
+                    "limit": limit
+                }
+            },
+            {"$project": {"surgery_type": 1, "summary": 1, "score": {"$meta": "vectorSearchScore"}}}
+        ])
+        
+        result = [
+            {
+                "id": str(surgery["_id"]),
+                "surgery_type": surgery.get("surgery_type", ""),
+                "summary": surgery.get("summary", ""),
+                "score": surgery.get("score"),
+            }
+            for surgery in surgeries
+        ]
+        
+        logger.info("Retrieved %d similar master surgeries for type '%s'", len(result), surgery_type)
+        return result
+    except Exception as e:
+        logger.error("Error searching similar master surgeries: %s", e)
+        return get_master_surgeries_by_type_db(surgery_type)
+
 def add_to_master_surgeries_db(
     surgery_type: str,
     procedure_steps: List[str],
@@ -100,49 +255,69 @@ def add_to_master_surgeries_db(
     Returns:
         ID of the master surgery document
     """
+    embedding = None
+    if settings.MASTER_VECTOR_INDEX:
+        try:
+            embedding = _embed_master_text(surgery_type, summary)
+        except Exception as e:
+            # The record is still written; it just won't be found by vector search
+            logger.error("Error embedding master surgery: %s", e)
+    
     try:
         master_id = mongodb_client.add_to_master_surgeries(
             surgery_type=surgery_type,
             procedure_steps=procedure_steps,
             summary=summary,
-            master_id=master_id
+            master_id=master_id,
+            embedding=embedding
         )
-        logger.info(f"Added to master surgeries with ID: {master_id}")
+        invalidate_master_cache()
+        logger.info("Added to master surgeries with ID: %s", master_id)
         return str(master_id)
     except Exception as e:
-        logger.error(f"Error adding to master surgeries: {str(e)}")
+        logger.error("Error adding to master surgeries: %s", e)
         return f"Error adding to master surgeries: {str(e)}"
 
 
-
-
-
-def get_master_surgeries_with_steps_db() -> List[Dict[str, Any]]:
+def get_master_surgeries_with_steps_page_db(
+    after_id: Optional[str] = None,
+    page_size: int = MASTER_PAGE_SIZE
+) -> Dict[str, Any]:
     """
-    Get all surgery details from the master surgeries collection
+    Get one page of surgery details from the master surgeries collection, in _id order
     
+    Args:
+        after_id: ID of the last surgery on the previous page, or None for the first page
+        page_size: Maximum number of surgeries to return
+        
     Returns:
-        List of all surgery details from master surgeries collection
+        Dictionary with the page's "surgeries" and the "next_after_id" to request the
+        following page, which is None on the last page. If the page can't be read,
+        "surgeries" is empty and "error" explains why
     """
+    if after_id and not ObjectId.is_valid(after_id):
+        return {"surgeries": [], "next_after_id": None, "error": f"Invalid after_id: {after_id}"}
+    
+    cache_key = f"page:{after_id}:{page_size}"
+    cached = _get_cached_master(cache_key)
+    if cached is not None:
+        return cached
+    
+    version = _master_version
     try:
-        # Always get all surgeries from the master collection
-        surgeries = mongodb_client.master_collection.find()
+        query = {"_id": {"$gt": ObjectId(after_id)}} if after_id else {}
+        surgeries = mongodb_client.master_collection.find(
+            query,
+            projection=MASTER_STEPS_PROJECTION
+        ).sort("_id", 1).limit(page_size)
         
-        # Convert to list and format the results
-        result = []
-        for surgery in surgeries:
-            # Get all procedure steps - if it's a nested array, flatten it
-            procedure_steps = surgery.get("procedure_steps", [])
-            
-            result.append({
-                "id": str(surgery["_id"]),
-                "surgery_type": surgery.get("surgery_type", ""),
-                "procedure_steps": procedure_steps,
-                "summary": surgery.get("summary", "")
-            })
+        result = [_format_master_surgery_with_steps(surgery) for surgery in surgeries]
+        next_after_id = result[-1]["id"] if len(result) == page_size else None
         
-        logger.info(f"Retrieved {len(result)} surgeries with procedure steps and summary from master collection")
-        return result
+        logger.info("Retrieved page of %d surgeries with procedure steps after %s", len(result), after_id)
+        page = {"surgeries": result, "next_after_id": next_after_id}
+        _set_cached_master(cache_key, version, page)
+        return page
     except Exception as e:
-        logger.error(f"Error retrieving master surgeries: {str(e)}")
-        return []
+        logger.error("Error retrieving page of master surgeries: %s", e)
+        return {"surgeries": [], "next_after_id": None, "error": f"Error retrieving master surgeries: {str(e)}"}
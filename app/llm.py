@@ -0,0 +1,36 @@
+from functools import lru_cache
+from langchain_google_vertexai import ChatVertexAI, VertexAIEmbeddings  # Uses Vertex AI as LLM
+from app.config import get_settings
+
+LLM_MODEL_NAME = "gemini-2.5-flash-preview-05-20"
+
+@lru_cache(maxsize=1)
+def get_llm() -> ChatVertexAI:
+    """
+    Shared Vertex AI chat model for all agents
+
+    Built once per process so the gRPC channel and credential bootstrap
+    happen a single time.
+    """
+    settings = get_settings()
+    return ChatVertexAI(
+        model_name=LLM_MODEL_NAME,
+        project=settings.GOOGLE_CLOUD_PROJECT or None,
+        location=settings.GOOGLE_CLOUD_LOCATION,
+        temperature=0.3,
+        top_p=0.9,
+        # Caps runaway generations; Gemini 2.5 counts thinking tokens against this
+        # limit, so leave headroom above the largest expected JSON response
+        max_output_tokens=8192,
+        streaming=False
+    )
+
+@lru_cache(maxsize=1)
+def get_embeddings() -> VertexAIEmbeddings:
+    """Shared Vertex AI embedding model for master surgery similarity search"""
+    settings = get_settings()
+    return VertexAIEmbeddings(
+        model_name=settings.EMBEDDING_MODEL_NAME,
+        project=settings.GOOGLE_CLOUD_PROJECT or None,
+        location=settings.GOOGLE_CLOUD_LOCATION
+    )
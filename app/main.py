@@ -1,25 +1,65 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import hashlib
 import logging
+import queue
+import tempfile
 import time
 import os
-from typing import Dict, Any
+from logging.handlers import QueueHandler, QueueListener
+from typing import BinaryIO, Callable, Dict, Any, Optional, Tuple
 from langchain_core.messages import HumanMessage
-from app.agent import analyze_surgury_analysis, comparison_surgery
+from pydantic import ValidationError
+from app.agent import analyze_surgury_analysis, comparison_surgery, parse_comparison_output
 from app.config import get_settings
-from app.vertex_ai_client import analyze_video as vertex_analyze_video
+from app.model import VideoAnalysisResponse, VideoComparisonResponse
+from app.vertex_ai_client import analyze_video_file as vertex_analyze_video_file
 
 settings = get_settings()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+def _configure_logging() -> Optional[QueueListener]:
+    """
+    Configure logging once for the whole application. Records are still formatted on
+    the calling thread when enqueued, but the stream write happens on a background
+    listener thread. Returns None if a queue handler is already installed, e.g. when
+    this module is imported more than once.
+    """
+    root_logger = logging.getLogger()
+    if any(isinstance(handler, QueueHandler) for handler in root_logger.handlers):
+        return None
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    log_queue = queue.SimpleQueue()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+_log_listener = _configure_logging()
 logger = logging.getLogger("app")
 
-app = FastAPI(title="Surgery Video Analysis API", version="1.0.0")
+# The Vertex AI pipeline is synchronous and takes minutes per video, so it runs on
+# its own bounded pool to keep the event loop free for other requests
+_analysis_executor = ThreadPoolExecutor(
+    max_workers=settings.MAX_CONCURRENT_ANALYSES,
+    thread_name_prefix="vertex-analysis"
+)
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    """Stop the analysis executor and the log listener when the app shuts down"""
+    yield
+    _analysis_executor.shutdown(wait=False, cancel_futures=True)
+    if _log_listener is not None:
+        _log_listener.stop()
+
+# The video endpoints declare response models, so their large analysis text is
+# serialized by pydantic-core rather than jsonable_encoder
+app = FastAPI(title="Surgery Video Analysis API", version="1.0.0", lifespan=_lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -30,6 +70,65 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+_VIDEO_EXTS = frozenset({".mp4", ".avi", ".mov", ".mkv"})
+
+def _validate_video(video: UploadFile) -> None:
+    """Reject uploads that are neither a video content type nor a known video extension"""
+    if (video.content_type or "").startswith("video/"):
+        return
+    if os.path.splitext(video.filename or "")[1].lower() not in _VIDEO_EXTS:
+        logger.error("File rejected: %s (type: %s)", video.filename, video.content_type)
+        raise HTTPException(status_code=400, detail="File must be a video")
+
+# Admission control: requests beyond MAX_CONCURRENT_ANALYSES wait briefly for a slot
+# and are then turned away, instead of queueing uploads on disk behind the executor
+_analysis_slots = asyncio.Semaphore(settings.MAX_CONCURRENT_ANALYSES)
+ANALYSIS_SLOT_TIMEOUT_SECONDS = 1.0
+
+# Uploads are copied to disk in pieces of this size rather than read whole into memory
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def _copy_upload(source: BinaryIO, suffix: str, max_bytes: int) -> Tuple[str, int, str]:
+    """
+    Copy an uploaded file to a temporary file, UPLOAD_CHUNK_SIZE bytes at a time,
+    giving up once it exceeds max_bytes. Blocks, so run it off the event loop.
+
+    Returns:
+        Path of the temporary file, the number of bytes written and the SHA-256 hex
+        digest of the content
+    """
+    size = 0
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_video:
+        try:
+            while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Video file exceeds {settings.MAX_VIDEO_SIZE_MB} MB")
+                digest.update(chunk)
+                temp_video.write(chunk)
+        except BaseException:
+            temp_video.close()
+            os.unlink(temp_video.name)
+            raise
+    return temp_video.name, size, digest.hexdigest()
+
+async def _save_upload(video: UploadFile) -> Tuple[str, int, str]:
+    """
+    Stream an uploaded video to a temporary file without blocking the event loop.
+
+    Returns:
+        Path of the temporary file, the number of bytes written and the SHA-256 hex
+        digest of the content
+    """
+    max_bytes = settings.MAX_VIDEO_SIZE_MB * 1024 * 1024
+    if video.size is not None and video.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Video file exceeds {settings.MAX_VIDEO_SIZE_MB} MB")
+
+    suffix = os.path.splitext(video.filename or "")[1] or ".mp4"
+    # Reads from the spooled upload and writes to disk both block, so copy in a thread
+    return await asyncio.to_thread(_copy_upload, video.file, suffix, max_bytes)
+
 @app.get("/")
 async def root():
     """Root endpoint to check if the API is running."""
@@ -39,45 +138,57 @@ async def root():
         "version": "1.0.0"
     }
 
-@app.post("/analyze-video")
-async def analyze_video(video: UploadFile = File(...)):
+async def _run_agent_on_video(video: UploadFile, agent, build_prompt: Callable[[str, str], str]) -> Dict[str, Any]:
     """
-    Upload a surgical video, analyze it using Vertex AI, and format the result with the agent.
-    Returns both the raw analysis and the agent-formatted output.
+    Analyze an uploaded surgical video with Vertex AI and pass the result to an agent.
+
+    Args:
+        video: The uploaded video file
+        agent: Agent executor to run on the raw analysis
+        build_prompt: Builds the agent's message from the raw analysis and video ID
+
+    Returns:
+        Dictionary with the video ID, file name, raw analysis, agent output and processing time
     """
+    _validate_video(video)
+    try:
+        await asyncio.wait_for(_analysis_slots.acquire(), timeout=ANALYSIS_SLOT_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("Rejected %s: all analysis slots are busy", video.filename)
+        raise HTTPException(status_code=503, detail="Server is busy analyzing other videos, try again later")
+    
+    video_path = None
     try:
-        # Validate video file
-        if not video.content_type.startswith('video/') and not video.filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-            logger.error(f"File rejected: {video.filename} (type: {video.content_type})")
-            raise HTTPException(status_code=400, detail="File must be a video")
-
-        # Read the video file
-        video_content = await video.read()
-        if len(video_content) == 0:
+        # Stream the video file to disk
+        video_path, video_size, video_hash = await _save_upload(video)
+        if video_size == 0:
             logger.error("Uploaded video file is empty.")
             raise HTTPException(status_code=400, detail="Video file is empty")
 
-        logger.info(f"Processing video: {video.filename}, size: {len(video_content)} bytes")
-        session_id = f"analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        logger.debug("Processing video: %s, size: %d bytes", video.filename, video_size)
         start_time = time.time()
 
         # Step 1: Raw analysis with Vertex AI
         logger.info("Starting raw video analysis with Vertex AI pipeline...")
-        raw_analysis = vertex_analyze_video(video_content)
+        raw_analysis = await asyncio.get_running_loop().run_in_executor(
+            _analysis_executor, vertex_analyze_video_file, video_path
+        )
         
-        # Format the analysis with the agent and store in database
+        # Step 2: Hand the analysis to the agent. The video is identified by its
+        # content hash, since different videos are often uploaded under the same name
         agent_input = {
-            "messages": [HumanMessage(content=f"Format the following surgical video analysis into a clear, professional medical report and store it in the database:\n\n{raw_analysis}\n\nVideo ID: {video.filename}")]
+            "messages": [HumanMessage(content=build_prompt(raw_analysis, video_hash))]
         }
-        agent_result = analyze_surgury_analysis.invoke(agent_input)
+        agent_result = await agent.ainvoke(agent_input)
         formatted_output = agent_result["output"] if isinstance(agent_result, dict) and "output" in agent_result else str(agent_result)
         
         processing_time = time.time() - start_time
 
-        logger.info(f"Video analysis and agent formatting completed in {processing_time:.2f} seconds")
+        logger.info("Video analysis and agent formatting completed in %.2f seconds", processing_time)
 
         return {
-            "video_id": video.filename,
+            "video_id": video_hash,
+            "filename": video.filename,
             "raw_analysis": raw_analysis,
             "agent_output": formatted_output,
             "processing_time_seconds": processing_time
@@ -85,58 +196,49 @@ async def analyze_video(video: UploadFile = File(...)):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error processing video: {str(e)}", exc_info=True)
+        logger.error("Error processing video: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error processing video: {str(e)}")
-    
+    finally:
+        _analysis_slots.release()
+        if video_path and os.path.exists(video_path):
+            os.unlink(video_path)
 
-@app.post("/compare-video")
-async def compare_video(video: UploadFile = File(...)):
+@app.post("/analyze-video", response_model=VideoAnalysisResponse)
+async def analyze_video(video: UploadFile = File(...)):
     """
     Upload a surgical video, analyze it using Vertex AI, and format the result with the agent.
     Returns both the raw analysis and the agent-formatted output.
     """
-    try:
-        # Validate video file
-        if not video.content_type.startswith('video/') and not video.filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv')):
-            logger.error(f"File rejected: {video.filename} (type: {video.content_type})")
-            raise HTTPException(status_code=400, detail="File must be a video")
-
-        # Read the video file
-        video_content = await video.read()
-        if len(video_content) == 0:
-            logger.error("Uploaded video file is empty.")
-            raise HTTPException(status_code=400, detail="Video file is empty")
-
-        logger.info(f"Processing video: {video.filename}, size: {len(video_content)} bytes")
-        session_id = f"analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        start_time = time.time()
-
-        # Step 1: Raw analysis with Vertex AI
-        logger.info("Starting raw video analysis with Vertex AI pipeline...")
-        raw_analysis = vertex_analyze_video(video_content)
-        
-        # Provide the analysis to the agent for comparison
-        agent_input = {
-            "messages": [HumanMessage(content=f"Here is the new surgical analysis. Please process it according to your instructions:\n\n{raw_analysis}\n\nVideo ID: {video.filename}")]
-        }
-        agent_result = comparison_surgery.invoke(agent_input)
-        formatted_output = agent_result["output"] if isinstance(agent_result, dict) and "output" in agent_result else str(agent_result)
-        
-        processing_time = time.time() - start_time
-
-        logger.info(f"Video analysis and agent formatting completed in {processing_time:.2f} seconds")
+    # Format the analysis with the agent and store in database
+    return await _run_agent_on_video(
+        video,
+        analyze_surgury_analysis,
+        lambda raw_analysis, video_id: f"Format the following surgical video analysis into a clear, professional medical report and store it in the database:\n\n{raw_analysis}\n\nVideo ID: {video_id}"
+    )
 
-        return {
-            "video_id": video.filename,
-            "raw_analysis": raw_analysis,
-            "agent_output": formatted_output,
-            "processing_time_seconds": processing_time
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error processing video: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Error processing video: {str(e)}")
+@app.post("/compare-video", response_model=VideoComparisonResponse)
+async def compare_video(video: UploadFile = File(...)):
+    """
+    Upload a surgical video, analyze it using Vertex AI, and compare the result with the
+    master surgeries using the agent.
+    Returns the raw analysis, the agent output and the parsed comparison.
+    """
+    # Provide the analysis to the agent for comparison
+    result = await _run_agent_on_video(
+        video,
+        comparison_surgery,
+        lambda raw_analysis, video_id: f"Here is the new surgical analysis. Please process it according to your instructions:\n\n{raw_analysis}\n\nVideo ID: {video_id}"
+    )
+    
+    # Validate the agent's JSON so clients get a structured comparison
+    try:
+        comparison = parse_comparison_output(result["agent_output"])
+    except ValidationError as e:
+        logger.warning("Comparison output did not match the expected schema: %s", e)
+        comparison = None
+    
+    result["comparison"] = comparison
+    return result
 
 
 @app.get("/health")
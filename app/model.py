@@ -1,4 +1,4 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Union
 from pydantic import BaseModel, Field
 
 class SurgeryVideoAnalysisResult(BaseModel):
@@ -25,11 +25,37 @@ class CombinedVideoAnalysis(BaseModel):
 class SurgeryAnalysisState(BaseModel):
     """Schema for the state of the surgery analysis agent."""
     video_id: str = Field(description="Name/ID of the video file")
-    video_bytes: Optional[bytes] = Field(None, description="Binary content of the video file")
-    video_chunks: Optional[List[bytes]] = Field(None, description="List of video chunks")
+    video_path: Optional[str] = Field(None, description="Path or GCS URI of the video file")
+    video_chunk_paths: Optional[List[str]] = Field(None, description="Paths or GCS URIs of the video chunks")
     current_chunk_index: int = Field(0, description="Index of the current chunk being processed")
     chunk_analyses: List[VideoChunkAnalysis] = Field(default_factory=list, description="List of analyses for each chunk")
     combined_analysis: Optional[str] = Field(None, description="Combined analysis from all chunks")
     structured_result: Optional[SurgeryVideoAnalysisResult] = Field(None, description="Structured analysis result")
     workflow_stage: str = Field("initialized", description="Current stage in the workflow")
     error: Optional[str] = Field(None, description="Error message if any")
+
+class MissingStep(BaseModel):
+    """Schema for a master procedure step absent from the current procedure."""
+    missing_step: str = Field(description="Description of the missing procedure step")
+    should_occur_after: str = Field(description="Timestamp in HH:MM:SS after which the step should have occurred")
+
+class ComparisonResult(BaseModel):
+    """Schema for the comparison agent's output."""
+    current_procedure_steps: List[str] = Field(description="Timestamped procedure steps from the fresh analysis")
+    master_procedure_steps: List[str] = Field(description="Procedure steps from the matched master record")
+    missing_steps: List[MissingStep] = Field(default_factory=list, description="Master steps not found in the current procedure")
+
+class VideoAnalysisResponse(BaseModel):
+    """Response of the /analyze-video endpoint."""
+    video_id: str = Field(description="SHA-256 hex digest of the uploaded video")
+    filename: Optional[str] = Field(None, description="Original file name of the uploaded video")
+    raw_analysis: str = Field(description="Timestamped analysis from the Vertex AI pipeline")
+    agent_output: str = Field(description="Final answer of the agent")
+    processing_time_seconds: float = Field(description="Time spent analyzing the video and running the agent")
+
+class VideoComparisonResponse(VideoAnalysisResponse):
+    """Response of the /compare-video endpoint."""
+    comparison: Optional[Union[ComparisonResult, str]] = Field(
+        None,
+        description="Parsed comparison, the no-similar-data message, or null if the agent output was invalid"
+    )
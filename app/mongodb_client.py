@@ -1,5 +1,7 @@
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
+from pymongo import ReturnDocument
+from bson.objectid import ObjectId
 from datetime import datetime
 from typing import Dict, List, Any, Optional
 from app.config import get_settings
@@ -7,12 +9,26 @@ import re
 
 settings = get_settings()
 
+# Keep at most this many of the most recent procedure steps on a master surgery
+MASTER_PROCEDURE_STEPS_CAP = 5000
+
 class MongoDBClient:
     """MongoDB client for surgery video analysis data storage and retrieval"""
     
     def __init__(self):
         """Initialize MongoDB connection with proper server API"""
-        self.client = MongoClient(settings.MONGODB_URI, server_api=ServerApi('1'))
+        self.client = MongoClient(
+            settings.MONGODB_URI,
+            server_api=ServerApi('1'),
+            maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+            minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
+            maxIdleTimeMS=60000,
+            serverSelectionTimeoutMS=5000,
+            socketTimeoutMS=15000,
+            retryWrites=True,
+            # Procedure steps and summaries are plain text and compress well
+            compressors="zlib"
+        )
         self.db = self.client[settings.MONGODB_DB_NAME]
         self.analysis_collection = self.db['analysis']
         self.master_collection = self.db['master_surgeries']
@@ -23,14 +39,29 @@ class MongoDBClient:
             print("✅ MongoDB connection successful")
         except Exception as e:
             print(f"❌ MongoDB connection failed: {e}")
+        
+        # Index surgery_type so master lookups by type don't scan the collection
+        try:
+            self.master_collection.create_index("surgery_type")
+        except Exception as e:
+            print(f"❌ Failed to create master_surgeries indexes: {e}")
+        
+        # Index video_id so analyses can be looked up and replaced per video. It stays
+        # non-unique: existing collections hold duplicate video_ids from the old
+        # insert path, so a unique index build would fail on them
+        try:
+            self.analysis_collection.create_index("video_id")
+        except Exception as e:
+            print(f"❌ Failed to create analysis indexes: {e}")
     
     def store_analysis(self, analysis_data: Dict[str, Any]) -> str:
         """
-        Store surgery video analysis in the analysis collection
+        Store surgery video analysis in the analysis collection, replacing any
+        earlier analysis of the same video
         
         Args:
             analysis_data: Dictionary containing analysis results
-                - video_id: Name/ID of the video file
+                - video_id: Content hash identifying the video file
                 - surgery_type: Type of surgery identified
                 - procedure_steps: List of timestamped procedure steps
                 - description: Detailed description of the procedure
@@ -43,91 +74,74 @@ class MongoDBClient:
         now = datetime.now().isoformat()
         analysis_data["created_at"] = now
         
-        # Insert into analysis collection
-        result = self.analysis_collection.insert_one(analysis_data)
-        return result.inserted_id
+        # Re-analyzing a video replaces its document instead of adding a duplicate
+        result = self.analysis_collection.find_one_and_replace(
+            {"video_id": analysis_data["video_id"]},
+            analysis_data,
+            projection={"_id": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return result["_id"]
     
     def add_to_master_surgeries(self, 
                                surgery_type: str, 
                                procedure_steps: List[str], 
                                summary: str,
-                               master_id: Optional[str] = None) -> str:
+                               master_id: Optional[str] = None,
+                               embedding: Optional[List[float]] = None) -> str:
         """
         Add or update master surgery information.
 
         If a match is found, it updates the top-level summary with the new synthesized
-        summary from the agent, appends procedure steps, and adds the original analysis
-        summary to a historical list.
+        summary from the agent and appends the procedure steps, all in a single
+        server-side update. Otherwise a new master surgery entry is created.
         
         Args:
             surgery_type: Type of surgery
             procedure_steps: List of procedure steps
             summary: The new or synthesized summary of the procedure
             master_id: Optional ID of an existing master surgery to update
+            embedding: Optional embedding of the surgery type and summary for vector search
             
         Returns:
             ID of the inserted/updated document
         """
-        # If master_id is provided, try to find that specific document
-        if master_id:
-            try:
-                from bson.objectid import ObjectId
-                existing = self.master_collection.find_one({"_id": ObjectId(master_id)})
-                if not existing:
-                    # If ID not found, fall back to surgery_type search
-                    existing = self.master_collection.find_one({"surgery_type": surgery_type})
-            except Exception:
-                # If ID is invalid, fall back to surgery_type search
-                existing = self.master_collection.find_one({"surgery_type": surgery_type})
-        else:
-            # Check if this surgery type already exists in master collection
-            existing = self.master_collection.find_one({"surgery_type": surgery_type})
+        now = datetime.now().isoformat()
+        update = {
+            "$set": {
+                "summary": summary,  # Overwrite the top-level summary
+                "last_updated": now
+            },
+            # Append on the server rather than reading the existing steps back, and
+            # trim to the newest steps so the document can't grow without bound
+            "$push": {"procedure_steps": {"$each": procedure_steps, "$slice": -MASTER_PROCEDURE_STEPS_CAP}},
+            # surgery_type is filled in from the filter when a new entry is created
+            "$setOnInsert": {"created_at": now}
+        }
+        if embedding is not None:
+            update["$set"]["embedding"] = embedding
         
-        if existing:
-            # Update existing master surgery
-            existing_steps = existing.get("procedure_steps", [])
-            all_steps = existing_steps + procedure_steps
-            
-            # original_types = existing.get("original_surgery_types", [])
-            # # Create a record of the original analysis that led to this update
-            # original_types.append({
-            #     "name": surgery_type,
-            #     "summary": summary # This is the summary from the new analysis
-            # })
-            
-            # Update document, replacing the top-level summary with the new one
-            self.master_collection.update_one(
-                {"_id": existing["_id"]},
-                {
-                    "$set": {
-                        "summary": summary,  # Overwrite the top-level summary
-                        "procedure_steps": all_steps,
-                        # "original_surgery_types": original_types,
-                        "last_updated": datetime.now().isoformat()
-                    }
-                }
+        # If a valid master_id is provided, try to update that specific document;
+        # otherwise fall back to the surgery_type match
+        if master_id and ObjectId.is_valid(master_id):
+            updated = self.master_collection.find_one_and_update(
+                {"_id": ObjectId(master_id)},
+                update,
+                projection={"_id": 1}
             )
-            
-            return str(existing["_id"])
-        else:
-            # Create new master surgery entry
-            now = datetime.now().isoformat()
-            master_data = {
-                "surgery_type": surgery_type,
-                "summary": summary,  # Add top-level summary on creation
-                "procedure_steps": procedure_steps,
-                # "original_surgery_types": [
-                #     {
-                #         "name": surgery_type,
-                #         "summary": summary
-                #     }
-                # ],
-                "created_at": now,
-                "last_updated": now
-            }
-            
-            result = self.master_collection.insert_one(master_data)
-            return str(result.inserted_id)
+            if updated:
+                return str(updated["_id"])
+        
+        # Update the master surgery for this surgery type, creating it if none exists
+        result = self.master_collection.find_one_and_update(
+            {"surgery_type": surgery_type},
+            update,
+            projection={"_id": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return str(result["_id"])
     
     def get_master_surgery_data(self, surgery_type: str) -> Optional[Dict[str, Any]]:
         """
@@ -137,9 +151,13 @@ class MongoDBClient:
             surgery_type: Type of surgery to find
             
         Returns:
-            Master surgery document or None if not found
+            Master surgery _id, surgery_type and summary, or None if not found
         """
-        return self.master_collection.find_one({"surgery_type": surgery_type})
+        # Leave out the ever-growing procedure_steps array
+        return self.master_collection.find_one(
+            {"surgery_type": surgery_type},
+            projection={"_id": 1, "surgery_type": 1, "summary": 1}
+        )
 
 # Singleton instance
 mongodb_client = MongoDBClient()
@@ -1,7 +1,11 @@
 from app.tools.analyze_video import (
-    add_to_master_surgeries
+    analyze_video_tool
+)
+from app.tools.db_tools import (
+    add_to_master_surgeries_tool
 )
 
 __all__ = [
-    "add_to_master_surgeries"
+    "analyze_video_tool",
+    "add_to_master_surgeries_tool"
 ]
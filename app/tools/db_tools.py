@@ -1,12 +1,13 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
+import orjson
 from langchain_core.tools import BaseTool, tool
 from pydantic import BaseModel, Field
-from app.db_functions import store_analysis_in_db, add_to_master_surgeries_db, get_master_surgeries_db, get_master_surgeries_with_steps_db
+from app.db_functions import store_analysis_in_db, add_to_master_surgeries_db, get_master_surgeries_db, find_similar_master_surgeries_db, get_master_surgeries_with_steps_page_db
 
 class StoreAnalysisInput(BaseModel):
     """Input for storing analysis results in the database."""
     video_id: str = Field(
-        description="Name/ID of the video file"
+        description="Video ID given with the analysis, a content hash of the video file; copy it exactly"
     )
     surgery_type: str = Field(
         description="Type of surgery identified in the video"
@@ -33,7 +34,7 @@ def store_analysis_tool(
     Store the surgery video analysis in the database.
     
     Args:
-        video_id: Name/ID of the video file
+        video_id: Video ID given with the analysis (content hash of the video file)
         surgery_type: Type of surgery identified in the video
         procedure_steps: List of timestamped procedure steps
         description: Detailed description of the procedure
@@ -68,29 +69,80 @@ class AddToMasterInput(BaseModel):
         description="Optional ID of an existing master surgery to update directly"
     )
 
+def _to_json(result: Dict[str, Any]) -> str:
+    """Serialize a tool result as compact JSON: the agent doesn't need indentation, and it costs tokens"""
+    return orjson.dumps(result).decode()
+
+# Last get_master_surgeries output, keyed by the identity of the list it was built from
+_serialized_master_surgeries: Optional[Tuple[List[Dict[str, Any]], str]] = None
+
 @tool("get_master_surgeries")
 def get_master_surgeries_tool() -> str:
     """
     Get all surgery details from the master surgeries collection.
-    Use this tool before adding to master surgeries to check if similar surgeries already exist.
+    Only use this tool as a fallback when find_similar_master_surgeries returns no candidates.
     This tool returns ALL surgeries in the master collection for comparison.
         
     Returns:
         JSON string with all surgery details from master surgeries collection
     """
+    global _serialized_master_surgeries
     surgeries = get_master_surgeries_db()
     
     if not surgeries:
         return "No matching surgeries found in the master collection."
     
+    # get_master_surgeries_db returns the same list while its cache is current, so
+    # the serialized output can be reused until the master collection changes
+    cached = _serialized_master_surgeries
+    if cached is not None and cached[0] is surgeries:
+        return cached[1]
+    
     # Format the result for better readability
     result = {
         "total_surgeries": len(surgeries),
         "surgeries": surgeries
     }
     
-    import json
-    return json.dumps(result, indent=2)
+    serialized = _to_json(result)
+    _serialized_master_surgeries = (surgeries, serialized)
+    return serialized
+
+class FindSimilarMasterInput(BaseModel):
+    """Input for finding similar surgeries in the master collection."""
+    surgery_type: str = Field(
+        description="Type of surgery identified in the video"
+    )
+    summary: str = Field(
+        description="Concise summary of the procedure"
+    )
+
+@tool("find_similar_master_surgeries", args_schema=FindSimilarMasterInput)
+def find_similar_master_surgeries_tool(surgery_type: str, summary: str) -> str:
+    """
+    Find the surgeries in the master collection most similar to the given surgery type and summary.
+    Use this tool before adding to master surgeries to find an existing record for the same surgery.
+    This tool returns a few pre-ranked candidates instead of the whole master collection.
+    
+    Args:
+        surgery_type: Type of surgery identified in the video
+        summary: Concise summary of the procedure
+        
+    Returns:
+        JSON string with the candidate surgery details, most similar first
+    """
+    surgeries = find_similar_master_surgeries_db(surgery_type, summary)
+    
+    if not surgeries:
+        return "No matching surgeries found in the master collection."
+    
+    # Format the result for better readability
+    result = {
+        "total_surgeries": len(surgeries),
+        "surgeries": surgeries
+    }
+    
+    return _to_json(result)
 
 @tool("add_to_master_surgeries", args_schema=AddToMasterInput)
 def add_to_master_surgeries_tool(
@@ -101,7 +153,7 @@ def add_to_master_surgeries_tool(
 ) -> str:
     """
     Add the analysis to the master surgeries collection.
-    Before using this tool, use get_master_surgeries to check if similar surgeries exist.
+    Before using this tool, use find_similar_master_surgeries to check if similar surgeries exist.
     
     Args:
         surgery_type: Type of surgery identified in the video
@@ -124,26 +176,39 @@ def add_to_master_surgeries_tool(
 
 
 
-@tool("get_master_surgeries_with_steps")
-def get_master_surgeries_with_steps_tool() -> str:
+class GetMasterSurgeriesWithStepsInput(BaseModel):
+    """Input for paging through master surgeries with their procedure steps."""
+    after_id: Optional[str] = Field(
+        default=None,
+        description="The next_after_id returned by the previous call; omit it to get the first page"
+    )
+
+@tool("get_master_surgeries_with_steps", args_schema=GetMasterSurgeriesWithStepsInput)
+def get_master_surgeries_with_steps_tool(after_id: Optional[str] = None) -> str:
     """
-    Get all surgery details from the master surgeries collection.
-    Use this tool before adding to master surgeries to check if similar surgeries already exist.
-    This tool returns ALL surgeries in the master collection for comparison.
+    Get one page of surgery details, including procedure steps, from the master surgeries collection.
+    Call it again with the returned next_after_id to get the next page; next_after_id is null on the last page.
+    
+    Args:
+        after_id: The next_after_id returned by the previous call, or None for the first page
         
     Returns:
-        JSON string with all surgery details from master surgeries collection
+        JSON string with the page of surgery details and the next_after_id
     """
-    surgeries = get_master_surgeries_with_steps_db()
+    page = get_master_surgeries_with_steps_page_db(after_id)
     
-    if not surgeries:
+    # Report failures explicitly so the model retries instead of treating them as
+    # the end of the collection
+    if page.get("error"):
+        return f"{page['error']}. Pass the next_after_id from the previous page, or omit it to start over."
+    
+    if not page["surgeries"]:
         return "No matching surgeries found in the master collection."
     
     # Format the result for better readability
     result = {
-        "total_surgeries": len(surgeries),
-        "surgeries": surgeries
+        "surgeries": page["surgeries"],
+        "next_after_id": page["next_after_id"]
     }
     
-    import json
-    return json.dumps(result, indent=2)
+    return _to_json(result)
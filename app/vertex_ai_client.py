@@ -2,132 +2,233 @@ from vertexai.preview.generative_models import GenerativeModel, Part
 import vertexai
 from google.cloud import aiplatform
 from google.oauth2 import service_account
+import asyncio
+import contextlib
+import csv
+import functools
+import logging
 import os
+import shutil
 import tempfile
+import threading
 import subprocess
-import math
 import time
-from typing import List, Tuple
+import uuid
+from typing import TYPE_CHECKING, Iterator, List, Optional, Tuple, Union
 from dotenv import load_dotenv
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential, retry_if_exception_type
 from google.api_core.exceptions import ResourceExhausted
 from datetime import datetime
 from app.config import get_settings
 
+if TYPE_CHECKING:
+    from google.cloud import storage
+
 load_dotenv()
 
+# Logging is configured by the application entrypoint
+logger = logging.getLogger("vertex_ai_client")
+
+MODEL_NAME = 'gemini-2.5-flash-preview-05-20'
+
 # Rate limiting configuration
 RATE_LIMIT_DELAY = 1.0  # seconds between requests
 EMBEDDING_RATE_LIMIT = 30  # requests per minute for text-embedding-gecko
-last_request_time = 0
+last_request_time = 0.0
+_rate_limit_lock = threading.Lock()
 
 class RateLimitError(Exception):
     """Custom exception for rate limiting"""
     pass
 
-def rate_limit():
-    """Simple rate limiting function"""
+def _reserve_request_slot() -> float:
+    """
+    Reserve the next request start, RATE_LIMIT_DELAY after the previous one, and
+    return how long the caller has to wait for it
+    """
     global last_request_time
-    current_time = time.time()
-    time_since_last = current_time - last_request_time
-    if time_since_last < RATE_LIMIT_DELAY:
-        time.sleep(RATE_LIMIT_DELAY - time_since_last)
-    last_request_time = time.time()
+    with _rate_limit_lock:
+        current_time = time.monotonic()
+        wait = last_request_time + RATE_LIMIT_DELAY - current_time
+        last_request_time = current_time + max(wait, 0.0)
+    return wait
+
+async def rate_limit_async():
+    """Space request starts RATE_LIMIT_DELAY apart without blocking the event loop"""
+    wait = _reserve_request_slot()
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+@functools.lru_cache(maxsize=4)
+def _get_model(name: str = MODEL_NAME) -> GenerativeModel:
+    """Shared GenerativeModel; only use after init_vertex_ai has run"""
+    return GenerativeModel(name)
+
+# The model's async client is bound to the event loop it was first used on, so all
+# async Vertex AI work runs on one long-lived loop in a background thread
+_vertex_loop = None
+_vertex_loop_lock = threading.Lock()
+
+def _run_on_vertex_loop(coro):
+    """Run a coroutine on the shared Vertex AI event loop and wait for its result"""
+    global _vertex_loop
+    with _vertex_loop_lock:
+        if _vertex_loop is None:
+            _vertex_loop = asyncio.new_event_loop()
+            threading.Thread(target=_vertex_loop.run_forever, name="vertex-ai-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _vertex_loop).result()
+
+@functools.lru_cache(maxsize=1)
+def _init_vertex_ai_once(project_id: str, location: str, credentials_path: str) -> None:
+    """Load the service account and initialize Vertex AI; failures are not cached"""
+    credentials = service_account.Credentials.from_service_account_file(credentials_path)
+    vertexai.init(project=project_id, location=location, credentials=credentials)
 
 def init_vertex_ai(project_id: str, location: str):
     try:
-        credentials = service_account.Credentials.from_service_account_file(
-            os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-        )
-        vertexai.init(project=project_id, location=location, credentials=credentials)
+        _init_vertex_ai_once(project_id, location, os.getenv('GOOGLE_APPLICATION_CREDENTIALS'))
     except Exception as e:
         raise Exception(f"Failed to initialize Vertex AI: {str(e)}")
 
-def split_video(video_bytes: bytes, chunk_duration: int = 600) -> List[Tuple[bytes, int, int]]:
+@functools.lru_cache(maxsize=1)
+def _get_storage_client() -> "storage.Client":
+    """Shared Cloud Storage client, using the same credentials as Vertex AI"""
+    # Only needed when VIDEO_CHUNK_BUCKET is set, so import it on first use
+    from google.cloud import storage
+    credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+    if credentials_path:
+        return storage.Client.from_service_account_json(credentials_path)
+    return storage.Client()
+
+def _upload_chunk(bucket_name: str, chunk_path: str, blob_name: str) -> str:
+    """Upload a chunk file to Cloud Storage and return its gs:// URI"""
+    _get_storage_client().bucket(bucket_name).blob(blob_name).upload_from_filename(chunk_path, content_type='video/mp4')
+    return f"gs://{bucket_name}/{blob_name}"
+
+def _delete_uploaded_chunks(chunk_uris: List[str]) -> None:
+    """Delete chunk objects that split_video uploaded to Cloud Storage"""
+    for chunk_uri in chunk_uris:
+        bucket_name, blob_name = chunk_uri[len("gs://"):].split("/", 1)
+        try:
+            _get_storage_client().bucket(bucket_name).blob(blob_name).delete()
+        except Exception as e:
+            logger.error("Failed to delete uploaded chunk %s: %s", chunk_uri, e)
+
+# How often split_video checks ffmpeg's segment list for newly finished segments
+SEGMENT_POLL_INTERVAL = 0.5
+
+def _read_segment_list(segment_list_path: str) -> List[List[str]]:
     """
-    Split video into chunks of specified duration (in seconds)
-    Returns list of tuples: (chunk_bytes, start_time, end_time)
+    Read the complete rows of ffmpeg's CSV segment list: segment file name, start
+    time and end time in seconds. ffmpeg rewrites the list as segments finish, so a
+    missing file or an unterminated last line just means it isn't there yet.
     """
-    chunks = []
-    
-    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_input:
-        temp_input.write(video_bytes)
-        temp_input_path = temp_input.name
+    try:
+        with open(segment_list_path, newline='') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return []
+    complete = content[:content.rfind('\n') + 1]
+    return [row for row in csv.reader(complete.splitlines()) if row]
+
+def split_video(video_path: str, chunk_duration: int = 600, gcs_bucket: str = "",
+                uploaded_uris: Optional[List[str]] = None) -> Iterator[Tuple[Union[bytes, str], int, int]]:
+    """
+    Split the video file at video_path into chunks of specified duration (in seconds)
+    Yields tuples: (chunk_bytes, start_time, end_time). When gcs_bucket is given, each
+    chunk is uploaded there and its gs:// URI is yielded instead of its bytes.
     
+    Chunks are read (or uploaded) one at a time as they are consumed. The temporary
+    segment files are removed when the generator is closed. Uploaded objects are
+    still referenced by analyses after that, so their URIs are appended to
+    uploaded_uris and deleting them is left to the caller.
+    """
+    output_dir = tempfile.mkdtemp(prefix='video_chunks_')
+    segment_list_path = os.path.join(output_dir, 'segments.csv')
+    if uploaded_uris is None:
+        uploaded_uris = []
+    process = None
     try:
-        # Get video duration using ffprobe
+        # Cut every segment in a single ffmpeg pass over the input. The segment
+        # list records each segment's actual start and end, so no ffprobe is needed
         cmd = [
-            'ffprobe', 
+            'ffmpeg',
+            '-nostdin',
             '-v', 'error',
-            '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            temp_input_path
+            '-i', video_path,
+            '-map', '0:v', '-map', '0:a?',
+            '-c', 'copy',
+            '-f', 'segment',
+            '-segment_time', str(chunk_duration),
+            '-segment_list', segment_list_path,
+            '-segment_list_type', 'csv',
+            '-reset_timestamps', '1',
+            '-y',
+            os.path.join(output_dir, 'chunk_%05d.mp4')
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        duration = float(result.stdout.strip())
+        # ffmpeg adds each segment to the list once it is complete, so chunks are
+        # handed out while later segments are still being cut
+        ffmpeg_log_path = os.path.join(output_dir, 'ffmpeg.log')
+        with open(ffmpeg_log_path, 'wb') as ffmpeg_log:
+            process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=ffmpeg_log)
         
-        num_chunks = math.ceil(duration / chunk_duration)
+        upload_prefix = f"video_chunks/{uuid.uuid4().hex}"
+        yielded = 0
+        while True:
+            finished = process.poll() is not None
+            for name, start, end in _read_segment_list(segment_list_path)[yielded:]:
+                yielded += 1
+                chunk_path = os.path.join(output_dir, name)
+                if gcs_bucket:
+                    # Upload once; every attempt then references the object by URI
+                    chunk_data = _upload_chunk(gcs_bucket, chunk_path, f"{upload_prefix}/{name}")
+                    uploaded_uris.append(chunk_data)
+                else:
+                    # Read the chunk bytes
+                    with open(chunk_path, 'rb') as f:
+                        chunk_data = f.read()
+                # The segment file is no longer needed once read or uploaded
+                os.unlink(chunk_path)
+                
+                yield (chunk_data, int(float(start)), int(float(end)))
+                del chunk_data
+            if finished:
+                break
+            time.sleep(SEGMENT_POLL_INTERVAL)
         
-        for i in range(num_chunks):
-            start_time = i * chunk_duration
-            end_time = min((i + 1) * chunk_duration, duration)
-            
-            with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_output:
-                output_path = temp_output.name
-            
-            # Extract video segment using ffmpeg
-            cmd = [
-                'ffmpeg',
-                '-ss', str(start_time),
-                '-i', temp_input_path,
-                '-t', str(end_time - start_time),
-                '-c', 'copy',
-                '-y',
-                output_path
-            ]
-            subprocess.run(cmd, check=True, capture_output=True)
-            
-            # Read the chunk bytes
-            with open(output_path, 'rb') as f:
-                chunk_bytes = f.read()
-            
-            chunks.append((chunk_bytes, start_time, end_time))
-            
-            # Clean up
-            os.unlink(output_path)
-            
+        if process.returncode != 0:
+            with open(ffmpeg_log_path, 'rb') as ffmpeg_log:
+                raise subprocess.CalledProcessError(process.returncode, cmd, stderr=ffmpeg_log.read())
     finally:
         # Clean up
-        if os.path.exists(temp_input_path):
-            os.unlink(temp_input_path)
-    
-    return chunks
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        shutil.rmtree(output_dir, ignore_errors=True)
 
+@functools.lru_cache(maxsize=4096)
 def format_timestamp(seconds: float) -> str:
     """Convert seconds to HH:MM:SS format"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    seconds = int(seconds % 60)
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=60),
-    retry=retry_if_exception_type(ResourceExhausted),
-    reraise=True
-)
-def analyze_video_chunk(chunk: Tuple[bytes, int, int]) -> str:
-    """Analyze a single video chunk with enhanced prompting for surgical procedures"""
-    chunk_bytes, start_time, end_time = chunk
-    
-    SYSTEM_INSTRUCTIONS = f"""
-    You are analyzing a surgical/medical procedure video segment from {format_timestamp(start_time)} to {format_timestamp(end_time)}.
+# Lower temperature for consistency of the per-chunk analyses
+CHUNK_GENERATION_CONFIG = {"temperature": 0.2}
+SUMMARY_GENERATION_CONFIG = {"temperature": 0.3}
+
+# Attempts per chunk before it is reported as failed
+CHUNK_MAX_ATTEMPTS = 3
+
+# Prompt sent with each chunk; only the chunk's timestamps change between calls
+CHUNK_PROMPT_TEMPLATE = """
+    You are analyzing a surgical/medical procedure video segment from {start} to {end}.
     
     **CRITICAL: ONLY describe what you can DIRECTLY SEE in the video frames.**
     
     Format your response as:
     
-    🕒 {format_timestamp(start_time)} – {format_timestamp(end_time)}
+    🕒 {start} – {end}
     Process: [Brief name of the surgical step/procedure observed]
     Explanation: [Detailed description of exactly what is happening - include specific actions, instruments used, anatomical structures visible, and any techniques demonstrated]
     
@@ -151,37 +252,105 @@ def analyze_video_chunk(chunk: Tuple[bytes, int, int]) -> str:
     
     **If you cannot see clearly, say so rather than guessing.**
     """
+
+async def analyze_video_chunk(chunk: Tuple[Union[bytes, str], int, int]) -> str:
+    """Analyze a single video chunk with enhanced prompting for surgical procedures"""
+    chunk_data, start_time, end_time = chunk
+    
+    start, end = format_timestamp(start_time), format_timestamp(end_time)
+    SYSTEM_INSTRUCTIONS = CHUNK_PROMPT_TEMPLATE.format(start=start, end=end)
     
     try:
-        rate_limit()  # Apply rate limiting
-        model = GenerativeModel('gemini-2.5-flash-preview-05-20')
-        video_part = Part.from_data(data=chunk_bytes, mime_type='video/mp4')
+        await rate_limit_async()  # Apply rate limiting
+        model = _get_model()
+        if isinstance(chunk_data, str):
+            video_part = Part.from_uri(chunk_data, mime_type='video/mp4')
+        else:
+            video_part = Part.from_data(data=chunk_data, mime_type='video/mp4')
         prompt_part = Part.from_text(SYSTEM_INSTRUCTIONS)
         
-        response = model.generate_content(
+        response = await model.generate_content_async(
             [video_part, prompt_part],
-            generation_config={"temperature": 0.2}  # Lower temperature for consistency
+            generation_config=CHUNK_GENERATION_CONFIG
         )
         
-        # Add a small delay between chunks to avoid rate limiting
-        time.sleep(1.0)
-        
         return response.text
     except ResourceExhausted as e:
-        print(f"Rate limit exceeded for chunk {format_timestamp(start_time)}-{format_timestamp(end_time)}, retrying...")
-        # Add exponential backoff
-        time.sleep(5)
+        print(f"Rate limit exceeded for chunk {start}-{end}, retrying...")
         raise
     except Exception as e:
-        print(f"Error analyzing video chunk {format_timestamp(start_time)}-{format_timestamp(end_time)}: {e}")
-        return f"""🕒 {format_timestamp(start_time)} – {format_timestamp(end_time)}
+        print(f"Error analyzing video chunk {start}-{end}: {e}")
+        return f"""🕒 {start} – {end}
 Process: Analysis Error
 Explanation: [Error analyzing this segment: {str(e)}]"""
 
-def generate_summary(successful_analyses: List[str]) -> str:
-    """Generate a structured summary from the analysis results"""
+async def _analyze_chunk_with_retries(index: int, chunk: Tuple[Union[bytes, str], int, int]) -> Tuple[str, bool]:
+    """
+    Analyze one chunk, retrying quota errors and empty responses with exponential backoff.
+    Returns the chunk's analysis (or an error segment) and whether it succeeded.
+    """
+    _, start_time, end_time = chunk
+    print(f"🔍 Processing chunk {index+1} ({format_timestamp(start_time)}-{format_timestamp(end_time)})...")
     
-    summary_prompt = """
+    try:
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(CHUNK_MAX_ATTEMPTS),
+            wait=wait_exponential(multiplier=1, min=4, max=60),
+            retry=retry_if_exception_type((ResourceExhausted, ValueError)),
+            reraise=True
+        ):
+            with attempt:
+                result = await analyze_video_chunk(chunk)
+                if not result or len(result.strip()) <= 20:  # Basic validation
+                    raise ValueError("Empty or invalid response from API")
+    except Exception as e:
+        print(f"❌ Failed to process chunk {index+1} after {CHUNK_MAX_ATTEMPTS} attempts")
+        return f"""🕒 {format_timestamp(start_time)} – {format_timestamp(end_time)}
+Process: Processing Failed
+Explanation: [Unable to analyze this segment after {CHUNK_MAX_ATTEMPTS} attempts: {str(e)}]""", False
+    
+    print(f"✅ Successfully processed chunk {index+1}")
+    return result, True
+
+async def _analyze_chunks(chunks: Iterator[Tuple[Union[bytes, str], int, int]], concurrency: int) -> List[Tuple[str, bool]]:
+    """
+    Analyze chunks with at most `concurrency` Vertex AI requests in flight, in chunk order.
+    The next chunk is only pulled from the iterator once a slot is free, so at most
+    `concurrency` chunks are held in memory.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def run(index: int, chunk: Tuple[Union[bytes, str], int, int]) -> Tuple[str, bool]:
+        try:
+            return await _analyze_chunk_with_retries(index, chunk)
+        finally:
+            semaphore.release()
+    
+    tasks = []
+    try:
+        while True:
+            await semaphore.acquire()
+            # Reading or uploading a chunk blocks, so keep it off the event loop
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                semaphore.release()
+                break
+            tasks.append(asyncio.create_task(run(len(tasks), chunk)))
+    except BaseException:
+        # Splitting failed part way; don't leave analyses of earlier chunks running
+        for task in tasks:
+            task.cancel()
+        # Let them finish cancelling so the caller can delete uploaded chunks
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    
+    return await asyncio.gather(*tasks)
+
+# Analyses are summarized in groups of this size, then the group summaries are
+# summarized, so long videos never produce one oversized summary prompt
+SUMMARY_GROUP_SIZE = 8
+
+SUMMARY_PROMPT = """
     Based on the following timestamped surgical procedure analysis, create a concise summary that:
     
     1. Identifies the type of surgical procedure
@@ -194,26 +363,59 @@ def generate_summary(successful_analyses: List[str]) -> str:
     [Brief description of the complete surgical procedure with main phases]
     
     Here are the detailed observations:
-    """ + "\n\n".join(successful_analyses)
-    
+    """
+
+async def _summarize_one(analyses: List[str]) -> str:
+    """Summarize a single group of analyses with one model call"""
+    await rate_limit_async()
+    summary_response = await _get_model().generate_content_async(
+        SUMMARY_PROMPT + "\n\n".join(analyses),
+        generation_config=SUMMARY_GENERATION_CONFIG
+    )
+    return summary_response.text
+
+async def generate_summary_async(analyses: List[str], group_size: int = SUMMARY_GROUP_SIZE) -> str:
+    """Summarize the analyses, reducing them group by group until one summary is left"""
+    while len(analyses) > group_size:
+        groups = [analyses[i:i + group_size] for i in range(0, len(analyses), group_size)]
+        analyses = await asyncio.gather(*(_summarize_one(group) for group in groups))
+    return await _summarize_one(analyses)
+
+def generate_summary(successful_analyses: List[str]) -> str:
+    """Generate a structured summary from the analysis results"""
     try:
-        rate_limit()
-        model = GenerativeModel('gemini-2.5-flash-preview-05-20')
-        summary_response = model.generate_content(
-            summary_prompt,
-            generation_config={"temperature": 0.3}
-        )
-        return summary_response.text
+        return _run_on_vertex_loop(generate_summary_async(successful_analyses))
     except Exception as e:
         return f"✅ Summary\nUnable to generate summary due to error: {str(e)}"
 
 def analyze_video(video_bytes: bytes) -> str:
+    """
+    Analyze a surgical video held in memory. See analyze_video_file.
+    
+    Args:
+        video_bytes: The video file content as bytes
+        
+    Returns:
+        str: Structured analysis of the video with timestamps and procedural breakdown
+    """
+    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as temp_input:
+        temp_input.write(video_bytes)
+        temp_input_path = temp_input.name
+    
+    try:
+        return analyze_video_file(temp_input_path)
+    finally:
+        # Clean up
+        if os.path.exists(temp_input_path):
+            os.unlink(temp_input_path)
+
+def analyze_video_file(video_path: str) -> str:
     """
     Analyze a surgical video by splitting it into chunks and providing structured analysis
     matching the expected format with timestamps and procedural breakdown.
     
     Args:
-        video_bytes: The video file content as bytes
+        video_path: Path to the video file on disk
         
     Returns:
         str: Structured analysis of the video with timestamps and procedural breakdown
@@ -226,51 +428,21 @@ def analyze_video(video_bytes: bytes) -> str:
         # Initialize Vertex AI with error handling
         init_vertex_ai(project_id, location)
         
-        # Split video into 10-minute chunks (adjust as needed)
+        # Split video into 10-minute chunks (adjust as needed) and analyze them
+        # concurrently, keeping the results in video order. Closing the splitter
+        # removes the segment files; uploaded chunks are deleted once every
+        # analysis that references them has finished
         print("🔄 Splitting video into chunks...")
-        chunks = split_video(video_bytes, chunk_duration=600)
-        print(f"✅ Split video into {len(chunks)} chunks for processing")
-        
-        # Process each chunk sequentially
-        results = []
-        successful_results = []
-        
-        for i, chunk in enumerate(chunks):
-            chunk_bytes, start_time, end_time = chunk
-            max_retries = 3
-            retry_count = 0
-            success = False
-            
-            while retry_count < max_retries and not success:
-                try:
-                    print(f"🔍 Processing chunk {i+1}/{len(chunks)} ({format_timestamp(start_time)}-{format_timestamp(end_time)})...")
-                    result = analyze_video_chunk(chunk)
-                    
-                    if result and len(result.strip()) > 20:  # Basic validation
-                        results.append(result)
-                        successful_results.append(result)
-                        success = True
-                        print(f"✅ Successfully processed chunk {i+1}")
-                        
-                        # Add delay between successful chunks to avoid rate limiting
-                        if i < len(chunks) - 1:
-                            time.sleep(2.0)
-                    else:
-                        raise ValueError("Empty or invalid response from API")
-                        
-                except Exception as e:
-                    retry_count += 1
-                    if retry_count >= max_retries:
-                        error_segment = f"""🕒 {format_timestamp(start_time)} – {format_timestamp(end_time)}
-Process: Processing Failed
-Explanation: [Unable to analyze this segment after {max_retries} attempts: {str(e)}]"""
-                        results.append(error_segment)
-                        print(f"❌ Failed to process chunk {i+1} after {max_retries} attempts")
-                        time.sleep(5)
-                    else:
-                        wait_time = 5 * retry_count
-                        print(f"🔄 Retry {retry_count}/{max_retries} for chunk {i+1} after error: {str(e)}. Waiting {wait_time}s...")
-                        time.sleep(wait_time)
+        uploaded_uris = []
+        try:
+            with contextlib.closing(split_video(video_path, chunk_duration=600, gcs_bucket=settings.VIDEO_CHUNK_BUCKET,
+                                                uploaded_uris=uploaded_uris)) as chunks:
+                outcomes = _run_on_vertex_loop(_analyze_chunks(chunks, settings.VERTEX_CONCURRENCY))
+        finally:
+            _delete_uploaded_chunks(uploaded_uris)
+        print(f"✅ Analyzed {len(outcomes)} video chunks")
+        results = [result for result, _ in outcomes]
+        successful_results = [result for result, success in outcomes if success]
         
         # Generate structured output
         if successful_results: